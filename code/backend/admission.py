@@ -0,0 +1,83 @@
+"""
+Per-session admission control for the backend
+Bounds how much work a single session can create: topics, inputs per topic, text length,
+submissions per second and categorization compute-seconds per minute
+(wall time of embedding and clustering a session's topics, LLM waits excluded)
+"""
+from dotenv import load_dotenv
+from collections import deque
+import math
+import os
+import threading
+import time
+
+load_dotenv()
+
+class QuotaExceeded(Exception): #Raised when a request is over a session limit, carries the HTTP status and a retry hint
+    def __init__(self, message, status_code=429, retry_after=None):
+        super().__init__(message)
+        self.status_code, self.retry_after = status_code, retry_after
+
+class SessionQuotas:
+    def __init__(self, max_topics=50, max_inputs_per_topic=500, max_text_length=2000, submissions_per_second=5, burst=10, cpu_seconds_per_minute=30):
+        self.max_topics, self.max_inputs_per_topic, self.max_text_length = max_topics, max_inputs_per_topic, max_text_length
+        self.submissions_per_second, self.burst, self.cpu_seconds_per_minute = submissions_per_second, burst, cpu_seconds_per_minute
+        self._lock = threading.Lock()
+        self._buckets = {} #{session_uid: (tokens, last_refill)} | Submission rate
+        self._cpu = {} #{session_uid: deque[(timestamp, cpu_seconds)]} | Categorization compute time over the last minute
+        self._pruned = time.monotonic()
+
+    def check_submission(self, session_uid): #Take one submission from the session's token bucket
+        with self._lock:
+            now = time.monotonic()
+            tokens, refilled = self._buckets.get(session_uid, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - refilled) * self.submissions_per_second)
+            if tokens < 1:
+                self._buckets[session_uid] = (tokens, now)
+                raise QuotaExceeded(f"Too many submissions for session {session_uid}", retry_after=math.ceil((1 - tokens) / self.submissions_per_second))
+            self._buckets[session_uid] = (tokens - 1, now)
+            if now - self._pruned >= 60: self._prune(now)
+
+    def _prune(self, now): #Drop accounting of idle sessions (full bucket, no usage in the window), caller holds the lock
+        self._pruned = now
+        refill_time = self.burst / self.submissions_per_second
+        for session_uid in [uid for uid, (_, refilled) in self._buckets.items() if now - refilled >= refill_time]: del self._buckets[session_uid]
+        for session_uid in [uid for uid, usage in self._cpu.items() if not usage or now - usage[-1][0] >= 60]: del self._cpu[session_uid]
+
+    def check_topic(self, session_uid, topic_count): #Admit a new topic for a session that already has topic_count topics
+        if topic_count >= self.max_topics: raise QuotaExceeded(f"Session {session_uid} reached the limit of {self.max_topics} topics")
+        self.check_submission(session_uid)
+
+    def check_input(self, session_uid, text, input_count): #Admit a new input for a topic that already has input_count inputs
+        if len(text) > self.max_text_length: raise QuotaExceeded(f"Text longer than {self.max_text_length} characters", status_code=413)
+        if input_count >= self.max_inputs_per_topic: raise QuotaExceeded(f"Topic reached the limit of {self.max_inputs_per_topic} inputs")
+        self.check_submission(session_uid)
+
+    def record_cpu(self, session_uid, cpu_seconds): #Account categorization compute time to a session
+        with self._lock:
+            now = time.monotonic()
+            self._cpu.setdefault(session_uid, deque()).append((now, cpu_seconds))
+            if now - self._pruned >= 60: self._prune(now)
+
+    def cpu_retry_after(self, session_uid): #Seconds until the session is back under its CPU budget, 0 if it may run now
+        with self._lock:
+            usage, now = self._cpu.get(session_uid), time.monotonic()
+            if not usage: return 0
+            while usage and now - usage[0][0] >= 60: usage.popleft()
+            used = sum(seconds for _, seconds in usage)
+            if used < self.cpu_seconds_per_minute: return 0
+            for timestamp, seconds in usage: #Wait until enough old usage has left the window
+                used -= seconds
+                if used < self.cpu_seconds_per_minute: return max(1, math.ceil(60 - (now - timestamp)))
+            return 60 #Budget of zero (or less) is never satisfied, wait a full window
+
+    def limits(self): return {"max_topics": self.max_topics, "max_inputs_per_topic": self.max_inputs_per_topic, "max_text_length": self.max_text_length, "submissions_per_second": self.submissions_per_second, "burst": self.burst, "cpu_seconds_per_minute": self.cpu_seconds_per_minute}
+
+quotas = SessionQuotas(
+    max_topics=int(os.getenv("SESSION_MAX_TOPICS", 50)),
+    max_inputs_per_topic=int(os.getenv("SESSION_MAX_INPUTS_PER_TOPIC", 500)),
+    max_text_length=int(os.getenv("SESSION_MAX_TEXT_LENGTH", 2000)),
+    submissions_per_second=float(os.getenv("SESSION_SUBMISSIONS_PER_SECOND", 5)),
+    burst=int(os.getenv("SESSION_SUBMISSION_BURST", 10)),
+    cpu_seconds_per_minute=float(os.getenv("SESSION_CPU_SECONDS_PER_MINUTE", 30)),
+)
@@ -0,0 +1,181 @@
+"""
+Categorization pipeline shared by the server and the offline tools
+Embeds texts, clusters them with KMeans, keeps cluster ids stable across runs and titles clusters via the LLM gateway
+"""
+from sklearn.cluster import KMeans
+from sklearn.metrics.pairwise import cosine_similarity
+from scipy.optimize import linear_sum_assignment
+from llm_gateway import gateway as llm
+from collections import Counter
+import hashlib
+import json
+import re
+import time
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+CLUSTER_MATCH_THRESHOLD = 0.5 #Minimum centroid cosine similarity for a cluster to keep its predecessor's id
+_embedders = {} #{model_name: SentenceTransformer} | Loaded once per process
+
+def get_embedder(model_name=EMBEDDING_MODEL): #Load (once) and return the sentence embedding model
+    if model_name not in _embedders:
+        from sentence_transformers import SentenceTransformer #Imported lazily, processes that only cluster precomputed embeddings never load torch
+        _embedders[model_name] = SentenceTransformer(model_name)
+    return _embedders[model_name]
+
+def embed_texts(texts, model_name=EMBEDDING_MODEL, batch_size=32, show_progress_bar=False): #Embed a list of texts in batches
+    return get_embedder(model_name).encode(texts, batch_size=batch_size, show_progress_bar=show_progress_bar)
+
+def determine_cluster_count(inputs): #Determine optimal number of clusters using GPT
+    sample_size = min(20, len(inputs))
+    sample_texts = inputs[:sample_size]
+    combined_text = "\n".join(f"{i+1}. {text[:150]}" for i, text in enumerate(sample_texts))
+    
+    prompt = f"""Analyze these {len(inputs)} text snippets (showing first {sample_size}) and determine the optimal number of categories/clusters to organize them.
+
+Text snippets:
+{combined_text}
+
+Total number of texts: {len(inputs)}
+
+Requirements:
+- Consider the diversity and similarity of topics
+- Minimum clusters: 2
+- Maximum clusters: {min(15, len(inputs))}
+- Balance between too broad (few clusters) and too granular (many clusters)
+- Defenitely prefer broad topics, especially if there is quite some variance between texts
+- Prevent too specific topics with niche and lump together titles, which aren't technical or official terms under all costs
+- Return ONLY a single number
+
+How many distinct categories would best organize these texts?"""
+
+    try:
+        cluster_count_str = llm.complete(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "You are an expert in text categorization. Analyze the texts and determine the optimal number of categories. Respond with only a number."},
+                {"role": "user", "content": prompt},
+            ], temperature=0.1, expected_output_tokens=10)
+        
+        cluster_count = int(re.search(r'\d+', cluster_count_str).group())
+        
+        # Validate and constrain the result
+        cluster_count = max(2, min(cluster_count, min(15, len(inputs))))
+        
+        print(f"  GPT suggested {cluster_count} clusters for {len(inputs)} inputs")
+        return cluster_count
+        
+    except Exception as e:
+        print(f"GPT cluster determination error: {e}, using fallback")
+        # Fallback to a reasonable default
+        fallback = max(2, min(5, len(inputs) // 3))
+        return fallback
+
+def categorize_texts(inputs, n_clusters=None, previous_clusters=None, embeddings=None, usage=None, next_cluster_id=None): #Categorize texts using embeddings and clustering, keeping cluster ids stable across runs (new ids start at next_cluster_id)
+    compute_start = time.perf_counter() #Embedding and clustering time is charged to usage["compute_seconds"], LLM waits are not
+    if embeddings is None: embeddings = embed_texts(inputs)
+    previous_clusters, compute_seconds = previous_clusters or [], time.perf_counter() - compute_start
+    
+    if n_clusters is None:
+        n_clusters = determine_cluster_count(inputs)
+    
+    compute_start = time.perf_counter()
+    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
+    labels, clusters, titles = kmeans.fit_predict(embeddings), [], set()
+    matches = match_clusters(kmeans.cluster_centers_, previous_clusters)
+    compute_seconds += time.perf_counter() - compute_start
+    if usage is not None: usage["compute_seconds"] = usage.get("compute_seconds", 0) + compute_seconds
+    next_id = next_unused_cluster_id(next_cluster_id, previous_clusters)
+
+    for cluster_id in range(n_clusters):
+        cluster_texts = [inputs[i] for i in range(len(inputs)) if labels[i] == cluster_id]
+        if not cluster_texts: continue
+        
+        previous = matches.get(cluster_id)
+        if previous and Counter(previous["texts"]) == Counter(cluster_texts): title = previous["title"] #Unchanged membership keeps its title
+        else: title = generate_title_with_gpt(cluster_texts)
+        
+        original_title, counter = title, 1 #Handle duplicate titles
+        while title in titles: title, counter = f"{original_title} ({counter})", counter + 1
+        titles.add(title)
+        
+        if previous: stable_id = previous["id"]
+        else: stable_id, next_id = next_id, next_id + 1
+        clusters.append({"id": stable_id, "title": title, "texts": cluster_texts, "centroid": [round(float(x), 5) for x in kmeans.cluster_centers_[cluster_id]]})
+
+    return clusters
+
+def match_clusters(centroids, previous_clusters): #Match new centroids to previous clusters by optimal assignment on cosine similarity
+    if not previous_clusters or len(previous_clusters[0]["centroid"]) != centroids.shape[1]: return {}
+    similarity = cosine_similarity(centroids, [cluster["centroid"] for cluster in previous_clusters])
+    rows, cols = linear_sum_assignment(-similarity)
+    return {row: previous_clusters[col] for row, col in zip(rows, cols) if similarity[row, col] >= CLUSTER_MATCH_THRESHOLD}
+
+def next_unused_cluster_id(counter, clusters): return max([counter or 0] + [cluster["id"] + 1 for cluster in clusters]) #Ids only ever grow, so a dropped cluster's id is never handed out again
+
+def format_clusters(clusters): return {cluster["title"]: cluster["texts"] for cluster in clusters} #Title -> texts view used by the frontend
+
+def topic_version(formatted): return hashlib.sha1(json.dumps(formatted, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16] #Content version of a formatted topic, deltas are only applied on top of the matching version
+
+def diff_clusters(previous_clusters, clusters): #Describe the change between two cluster lists by stable id, keyed by titles for the frontend
+    before, after = {c["id"]: c for c in previous_clusters}, {c["id"]: c for c in clusters}
+    delta = {"added": {}, "removed": [], "renamed": {}, "texts_added": {}, "texts_removed": {}}
+    
+    for cluster_id, old in before.items():
+        if cluster_id not in after: delta["removed"].append(old["title"])
+    
+    for cluster_id, new in after.items():
+        old = before.get(cluster_id)
+        if old is None:
+            delta["added"][new["title"]] = new["texts"]
+            continue
+        if old["title"] != new["title"]: delta["renamed"][old["title"]] = new["title"]
+        old_counts, new_counts = Counter(old["texts"]), Counter(new["texts"])
+        if new_counts - old_counts: delta["texts_added"][new["title"]] = list((new_counts - old_counts).elements())
+        if old_counts - new_counts: delta["texts_removed"][new["title"]] = list((old_counts - new_counts).elements())
+    
+    return {key: value for key, value in delta.items() if value}
+
+def generate_title_with_gpt(texts): #Generate category title using GPT
+    sample_texts = texts[:5] if len(texts) > 5 else texts
+    combined_text = "\n".join(f"- {text[:200]}" for text in sample_texts)
+    
+    prompt = f"""Analyze these text snippets and generate a short, descriptive category title (2-4 words maximum).
+
+Text snippets:
+{combined_text}
+
+Requirements:
+- Maximum 4 words
+- Capitalize each word
+- Be specific and descriptive
+- No articles (a, an, the)
+- Examples: "Machine Learning Research", "Climate Policy", "Space Exploration"
+
+Category title:"""
+
+    try:
+        title = llm.complete(model="gpt-5-nano", messages=[{"role": "system", "content": "You are a text categorization expert. Generate concise, accurate category titles."}, {"role": "user", "content": prompt}], expected_output_tokens=20)
+        title = (title or "").strip().strip('"\'')
+        title = ' '.join(word.capitalize() for word in title.split())
+        
+        if len(title.split()) > 4 or not title: return extract_fallback_title(texts)
+        
+        return title
+        
+    except Exception as e:
+        print(f"GPT API error: {e}")
+        return extract_fallback_title(texts)
+
+def extract_fallback_title(texts): #Fallback title generation if GPT fails
+    combined = " ".join(texts)
+    words = combined.lower().split()
+    stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'from', 'is', 'are', 'was', 'were', 'been', 'be', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'must', 'can', 'this', 'that', 'these', 'those', 'i', 'you', 'he', 'she', 'it', 'we', 'they', 'them', 'their', 'its'}
+    
+    word_freq = Counter()
+    for word in words:
+        clean = re.sub(r'[^\w]', '', word)
+        if clean not in stop_words and len(clean) > 3 and not clean.isdigit(): word_freq[clean] += 1
+    if not word_freq: return "General Topics"
+    
+    top_words = [word for word, _ in word_freq.most_common(2)]
+    return ' '.join(word.capitalize() for word in top_words)
@@ -0,0 +1,151 @@
+"""
+Shared gateway for all LLM calls of the backend
+One pooled client, a global concurrency and token-rate budget, per-call deadlines,
+deduplication of identical in-flight prompts and a circuit breaker
+"""
+from openai import OpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
+from dotenv import load_dotenv
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import hashlib
+import json
+import os
+import threading
+import time
+
+load_dotenv()
+
+class LLMUnavailable(Exception): pass #Raised when a call is rejected by the budget, deadline or circuit breaker
+
+PROVIDER_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError) #Errors that mean the provider is unhealthy, not that the request was bad
+
+class LLMGateway:
+    def __init__(self, api_key, max_concurrency=4, tokens_per_minute=200000, timeout=20, failure_threshold=3, cooldown=30):
+        self.api_key, self.timeout, self.max_concurrency = api_key, timeout, max_concurrency
+        self.tokens_per_minute, self.failure_threshold, self.cooldown = tokens_per_minute, failure_threshold, cooldown
+        self._client, self._slots, self._lock = None, threading.BoundedSemaphore(max_concurrency), threading.Lock()
+        self._tokens, self._refilled = float(tokens_per_minute), time.monotonic() #Token bucket
+        self._in_flight = {} #{prompt_key: Future} | Identical prompts share one request
+        self._failures, self._opened_at, self._probing = 0, None, False #Circuit breaker state
+        self.stats = {"calls": 0, "coalesced": 0, "failures": 0, "rejected": 0}
+
+    @property
+    def client(self): #Single pooled client, created lazily so importing never needs an API key
+        with self._lock:
+            if self._client is None: self._client = OpenAI(api_key=self.api_key, timeout=self.timeout, max_retries=0)
+            return self._client
+
+    def circuit_state(self):
+        with self._lock:
+            if self._opened_at is None: return "closed"
+            return "half-open" if time.monotonic() - self._opened_at >= self.cooldown else "open"
+
+    def available(self): return self.circuit_state() != "open" #False while the provider is considered down
+
+    def complete(self, model, messages, deadline=None, expected_output_tokens=500, **kwargs): #Run a chat completion and return its text, raises LLMUnavailable or the provider error
+        deadline = time.monotonic() + (deadline or self.timeout)
+        key = hashlib.sha1(json.dumps([model, messages, kwargs], sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+        with self._lock:
+            future, owner = self._in_flight.get(key), False
+            if future is None: future, owner = self._in_flight.setdefault(key, Future()), True
+            else: self.stats["coalesced"] += 1
+        if not owner:
+            try: return future.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeout: self._reject("deadline exceeded waiting for identical request")
+
+        try:
+            result = self._call(model, messages, deadline, expected_output_tokens, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock: self._in_flight.pop(key, None)
+
+    def _call(self, model, messages, deadline, expected_output_tokens, **kwargs):
+        probe = self._enter_circuit()
+        try:
+            if not self._slots.acquire(timeout=max(0, deadline - time.monotonic())): self._reject("no concurrency slot before deadline")
+        except LLMUnavailable:
+            self._end_probe(probe)
+            raise
+        try:
+            self._take_tokens(sum(len(m["content"]) for m in messages) // 4 + expected_output_tokens, deadline)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: self._reject("deadline exceeded")
+            with self._lock: self.stats["calls"] += 1
+            try:
+                response = self.client.with_options(timeout=remaining).chat.completions.create(model=model, messages=messages, **kwargs)
+            except PROVIDER_ERRORS:
+                self._record(success=False)
+                raise
+            self._record(success=True)
+            return response.choices[0].message.content
+        finally:
+            self._slots.release()
+            self._end_probe(probe)
+
+    def _enter_circuit(self): #Fail fast while open, let a single probe through once the cooldown has passed, returns True for the probe
+        state = self.circuit_state()
+        with self._lock:
+            reject = state == "open" or (state == "half-open" and self._probing)
+            probe = not reject and state == "half-open"
+            if probe: self._probing = True
+        if reject: self._reject("circuit open")
+        return probe
+
+    def _end_probe(self, probe):
+        if probe:
+            with self._lock: self._probing = False
+
+    def _record(self, success):
+        with self._lock:
+            if success: self._failures, self._opened_at = 0, None
+            else:
+                self._failures, self.stats["failures"] = self._failures + 1, self.stats["failures"] + 1
+                if self._failures >= self.failure_threshold or self._opened_at is not None:
+                    if self._opened_at is None: print(f"LLM circuit opened after {self._failures} failures, using local fallbacks for {self.cooldown}s")
+                    self._opened_at = time.monotonic()
+
+    def _take_tokens(self, tokens, deadline): #Wait for the token bucket to cover the estimated request size
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) * 60 / self.tokens_per_minute
+            if now + wait > deadline: self._reject("token budget exhausted before deadline")
+            time.sleep(min(wait, 1))
+
+    def _refill(self): #Top up the token bucket for the time passed, caller holds the lock
+        now = time.monotonic()
+        self._tokens = min(self.tokens_per_minute, self._tokens + (now - self._refilled) * self.tokens_per_minute / 60)
+        self._refilled = now
+        return now
+
+    def _reject(self, reason):
+        with self._lock: self.stats["rejected"] += 1
+        raise LLMUnavailable(reason)
+
+    def share(self, parts, slots): #New gateway for one of parts worker processes: 1/parts of the token budget, concurrency from the slots semaphore shared by all of them
+        shared = LLMGateway(self.api_key, max_concurrency=self.max_concurrency, tokens_per_minute=max(1, self.tokens_per_minute // parts), timeout=self.timeout, failure_threshold=self.failure_threshold, cooldown=self.cooldown)
+        shared._slots = slots
+        return shared
+
+    def status(self):
+        with self._lock:
+            self._refill()
+            stats, tokens = dict(self.stats), int(self._tokens)
+        return {**stats, "circuit": self.circuit_state(), "tokens_available": tokens}
+
+gateway = LLMGateway(
+    os.getenv("OPENAI_API_KEY"),
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 4)),
+    tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", 200000)),
+    timeout=float(os.getenv("LLM_TIMEOUT", 20)),
+    failure_threshold=int(os.getenv("LLM_FAILURE_THRESHOLD", 3)),
+    cooldown=float(os.getenv("LLM_COOLDOWN", 30)),
+)
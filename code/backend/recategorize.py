@@ -0,0 +1,181 @@
+"""
+Offline bulk re-categorization of stored topics
+Embeds all texts in large batches, clusters topics in parallel across a process pool
+and writes the results atomically, so model or parameter changes can be rolled out over a whole archive
+
+Usage: python recategorize.py [--session NAME ...] [--workers N] [--batch-size N] [--active-only] [--reset-ids] [--no-forward]
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from threadpoolctl import threadpool_limits
+import argparse
+import json
+import multiprocessing
+import os
+import requests
+import tempfile
+import time
+
+import categorization
+from llm_gateway import gateway
+
+SESSIONS_FOLDER, FRONTEND_URL = "sessions_folder", "http://localhost:3000"
+
+def find_topic_files(sessions_folder, sessions=None, active_only=False):
+    """Collect the topic files of all sessions, or only of the selected ones"""
+    topic_files = []
+    for folder in sorted(os.listdir(sessions_folder)):
+        folder_path = os.path.join(sessions_folder, folder)
+        if not os.path.isdir(folder_path) or (sessions and folder not in sessions):
+            continue
+
+        for file in sorted(os.listdir(folder_path)):
+            if file.endswith(".json") and not (active_only and file.endswith("_finished.json")):
+                topic_files.append(os.path.join(folder_path, file))
+    return topic_files
+
+def write_json_atomic(file_path, data, mode=None):
+    """Write JSON to a temporary file in the same folder and swap it in, so readers never see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        os.chmod(tmp_path, mode if mode is not None else 0o666 & ~current_umask())  # mkstemp creates 0600 files
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def current_umask():
+    """Read the process umask (it can only be read by setting it)"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def init_worker(workers, llm_slots):
+    """Give every worker process its share of the LLM budget and of the CPU threads"""
+    categorization.llm = gateway.share(workers, llm_slots)  # All workers together never exceed LLM_MAX_CONCURRENCY calls
+    threadpool_limits(max(1, (os.cpu_count() or 1) // workers))  # Keep KMeans/BLAS pools from oversubscribing the CPU
+
+def categorize_topic(file_path, inputs, embeddings, previous_clusters, n_clusters, next_cluster_id):
+    """Cluster and title one topic from precomputed embeddings (runs in a worker process)"""
+    if n_clusters is not None:
+        n_clusters = min(n_clusters, len(inputs))
+    clusters = categorization.categorize_texts(inputs, n_clusters=n_clusters, previous_clusters=previous_clusters, embeddings=embeddings, next_cluster_id=next_cluster_id)
+    return file_path, clusters
+
+def forward_to_frontend(frontend_url, session_uid, topic_uid, formatted, version):
+    """Send the full re-categorized topic to the frontend, returns True if it was accepted"""
+    try:
+        response = requests.post(f"{frontend_url}/update", json={"session_uid": session_uid, "formatted": {topic_uid: formatted}, "versions": {topic_uid: version}}, timeout=5)
+        return response.status_code == 200
+    except requests.exceptions.RequestException:
+        return False
+
+def save_result(file_path, inputs, clusters, frontend_url=None):
+    """Merge clusters into the current file content, the live server may have added inputs meanwhile"""
+    try:
+        with open(file_path, "r") as f:
+            data, mode = json.load(f), os.stat(f.fileno()).st_mode & 0o777
+    except FileNotFoundError:
+        print(f"- Skipped (file moved or deleted): {file_path}")
+        return False
+
+    data["next_cluster_id"] = categorization.next_unused_cluster_id(data.get("next_cluster_id"), data.get("clusters", []) + clusters)
+    data["clusters"], data["formatted"] = clusters, categorization.format_clusters(clusters)
+    data["checked"] = data.get("inputs", []) == inputs  # Let the server reprocess if inputs changed
+
+    # Without a confirmed full update the frontend still shows the old categorization,
+    # clearing the version makes the live server send the full topic instead of a delta next time
+    version = categorization.topic_version(data["formatted"])
+    forwarded = False
+    if frontend_url and data.get("session_uid") and data.get("topic_uid"):
+        forwarded = forward_to_frontend(frontend_url, data["session_uid"], data["topic_uid"], data["formatted"], version)
+    data["version"] = version if forwarded else None
+    write_json_atomic(file_path, data, mode)
+
+    # /end-topic may have renamed the file while we worked, then our write recreated the active file next to it
+    finished_path = file_path[:-len(".json")] + "_finished.json"
+    if not file_path.endswith("_finished.json") and os.path.exists(finished_path):
+        os.replace(file_path, finished_path)
+        print(f"- Topic finished meanwhile, saved to: {finished_path}")
+    return True
+
+def recategorize(sessions_folder, sessions=None, workers=None, batch_size=256, active_only=False, reset_ids=False, n_clusters=None, embedding_model=categorization.EMBEDDING_MODEL, frontend_url=FRONTEND_URL):
+    """Re-categorize all selected topics and report progress and throughput"""
+    if not os.path.exists(sessions_folder):
+        print(f"Sessions folder not found: {sessions_folder}")
+        return
+
+    topics = []
+    for file_path in find_topic_files(sessions_folder, sessions, active_only):
+        try:
+            with open(file_path, "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"✗ Error reading {file_path}: {e}")
+            continue
+        if len(data.get("inputs", [])) >= 2:
+            topics.append((file_path, data))
+        else:
+            print(f"- Not enough inputs to categorize: {file_path}")
+
+    if not topics:
+        print("No topics to re-categorize")
+        return
+
+    # Embed every distinct text once, in large batches
+    texts = list(dict.fromkeys(text for _, data in topics for text in data["inputs"]))
+    print(f"Embedding {len(texts)} distinct texts from {len(topics)} topics with {embedding_model}...")
+    start = time.monotonic()
+    vectors = categorization.embed_texts(texts, model_name=embedding_model, batch_size=batch_size, show_progress_bar=True)
+    index = {text: i for i, text in enumerate(texts)}
+    elapsed = time.monotonic() - start
+    print(f"Embedded {len(texts)} texts in {elapsed:.1f}s ({len(texts) / max(elapsed, 1e-9):.0f} texts/s)\n")
+
+    # Cluster topics in parallel, spawned rather than forked since torch/OpenMP thread pools are already running here
+    workers = min(workers or os.cpu_count() or 1, len(topics))
+    context = multiprocessing.get_context("spawn")
+    llm_slots = context.BoundedSemaphore(gateway.max_concurrency)  # One concurrency budget shared by all workers
+    done, failed, text_count, start = 0, 0, 0, time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(workers, llm_slots)) as pool:
+        futures = {}
+        for file_path, data in topics:
+            inputs = data["inputs"]
+            previous_clusters = [] if reset_ids else data.get("clusters", [])
+            next_cluster_id = categorization.next_unused_cluster_id(data.get("next_cluster_id"), data.get("clusters", []))  # Fresh ids after --reset-ids still never reuse old ones
+            future = pool.submit(categorize_topic, file_path, inputs, vectors[[index[text] for text in inputs]], previous_clusters, n_clusters, next_cluster_id)
+            futures[future] = (file_path, inputs)
+
+        for future in as_completed(futures):
+            file_path, inputs = futures[future]
+            try:
+                _, clusters = future.result()
+                if save_result(file_path, inputs, clusters, frontend_url):
+                    done += 1
+                    text_count += len(inputs)
+                    elapsed = time.monotonic() - start
+                    print(f"✓ [{done + failed}/{len(topics)}] {file_path}: {len(clusters)} clusters | {done / elapsed:.2f} topics/s, {text_count / elapsed:.0f} texts/s")
+                else:
+                    failed += 1
+            except Exception as e:
+                failed += 1
+                print(f"✗ [{done + failed}/{len(topics)}] Error processing {file_path}: {e}")
+
+    elapsed = time.monotonic() - start
+    print(f"\nRe-categorized {done} topics ({text_count} texts) in {elapsed:.1f}s with {workers} workers, {failed} failed")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-categorize stored topics offline")
+    parser.add_argument("--sessions-folder", default=SESSIONS_FOLDER, help="Folder containing the session folders")
+    parser.add_argument("--session", action="append", dest="sessions", help="Only re-categorize this session (repeatable)")
+    parser.add_argument("--workers", type=int, default=None, help="Clustering processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=256, help="Embedding batch size")
+    parser.add_argument("--clusters", type=int, default=None, help="Fixed number of clusters instead of asking GPT")
+    parser.add_argument("--embedding-model", default=categorization.EMBEDDING_MODEL, help="Sentence transformer model")
+    parser.add_argument("--active-only", action="store_true", help="Skip finished topics")
+    parser.add_argument("--reset-ids", action="store_true", help="Ignore previous clusters and assign fresh ids")
+    parser.add_argument("--frontend-url", default=FRONTEND_URL, help="Frontend that receives the re-categorized topics")
+    parser.add_argument("--no-forward", action="store_true", help="Do not push results to the frontend, the live server sends full topics on its next update instead")
+    args = parser.parse_args()
+
+    recategorize(args.sessions_folder, args.sessions, args.workers, args.batch_size, args.active_only, args.reset_ids, args.clusters, args.embedding_model, None if args.no_forward else args.frontend_url)
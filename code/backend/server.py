@@ -1,25 +1,29 @@
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from sentence_transformers import SentenceTransformer
-from sklearn.cluster import KMeans
-from openai import OpenAI
+from llm_gateway import gateway as llm
+from categorization import categorize_texts, next_unused_cluster_id, format_clusters, diff_clusters, topic_version, embed_texts
+from admission import quotas, QuotaExceeded
 from dotenv import load_dotenv
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import json
+import re
 import os
 import requests
-import re
 from datetime import datetime
+from urllib.parse import quote
 import asyncio
 import math
+import hashlib
+import threading
 
 load_dotenv()
 
 app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["Retry-After"])
 
-FRONTEND_URL, SESSIONS_FOLDER, OPENAI_API_KEY, CHECK_INTERVAL = "http://localhost:3000", "sessions_folder", os.getenv("OPENAI_API_KEY"), 10 #seconds | Configuration
+FRONTEND_URL, SESSIONS_FOLDER, CHECK_INTERVAL = "http://localhost:3000", "sessions_folder", 10 #seconds | Configuration
 
 if os.path.exists(SESSIONS_FOLDER): #Clean sessions folder on startup
     import shutil
@@ -32,125 +36,10 @@ if os.path.exists(SESSIONS_FOLDER): #Clean sessions folder on startup
 
 os.makedirs(SESSIONS_FOLDER, exist_ok=True)
 updated_topics, processing_active = [], True #Global state
+summary_cache, SUMMARY_CACHE_SIZE, summary_lock = {}, 4096, threading.Lock() #{content_key: summary} | Cluster, topic and session summaries keyed by what they were built from
 
-#CATEGORIZATION FUNCTIONS
-def determine_cluster_count(inputs, client): #Determine optimal number of clusters using GPT
-    sample_size = min(20, len(inputs))
-    sample_texts = inputs[:sample_size]
-    combined_text = "\n".join(f"{i+1}. {text[:150]}" for i, text in enumerate(sample_texts))
-    
-    prompt = f"""Analyze these {len(inputs)} text snippets (showing first {sample_size}) and determine the optimal number of categories/clusters to organize them.
-
-Text snippets:
-{combined_text}
-
-Total number of texts: {len(inputs)}
-
-Requirements:
-- Consider the diversity and similarity of topics
-- Minimum clusters: 2
-- Maximum clusters: {min(15, len(inputs))}
-- Balance between too broad (few clusters) and too granular (many clusters)
-- Defenitely prefer broad topics, especially if there is quite some variance between texts
-- Prevent too specific topics with niche and lump together titles, which aren't technical or official terms under all costs
-- Return ONLY a single number
-
-How many distinct categories would best organize these texts?"""
-
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are an expert in text categorization. Analyze the texts and determine the optimal number of categories. Respond with only a number."},
-                {"role": "user", "content": prompt},
-            ], temperature=0.1,)
-        
-        cluster_count_str = response.choices[0].message.content.strip()
-        cluster_count = int(re.search(r'\d+', cluster_count_str).group())
-        
-        # Validate and constrain the result
-        cluster_count = max(2, min(cluster_count, min(15, len(inputs))))
-        
-        print(f"  GPT suggested {cluster_count} clusters for {len(inputs)} inputs")
-        return cluster_count
-        
-    except Exception as e:
-        print(f"GPT cluster determination error: {e}, using fallback")
-        # Fallback to a reasonable default
-        fallback = max(2, min(5, len(inputs) // 3))
-        return fallback
-
-def categorize_texts(inputs, n_clusters=None): #Categorize texts using embeddings and clustering
-    embedder = SentenceTransformer("all-MiniLM-L6-v2")
-    embeddings = embedder.encode(inputs)
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    
-    if n_clusters is None:
-        n_clusters = determine_cluster_count(inputs, client)
-    
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    labels, results = kmeans.fit_predict(embeddings), {}
-
-    for cluster_id in range(n_clusters):
-        cluster_texts = [inputs[i] for i in range(len(inputs)) if labels[i] == cluster_id]
-        if not cluster_texts: continue
-        
-        title = generate_title_with_gpt(cluster_texts, client)
-        
-        original_title, counter = title, 1 #Handle duplicate titles
-        while title in results: title, counter = f"{original_title} ({counter})", counter + 1
-        
-        results[title] = cluster_texts
-
-    return results
-
-def generate_title_with_gpt(texts, client): #Generate category title using GPT
-    sample_texts = texts[:5] if len(texts) > 5 else texts
-    combined_text = "\n".join(f"- {text[:200]}" for text in sample_texts)
-    
-    prompt = f"""Analyze these text snippets and generate a short, descriptive category title (2-4 words maximum).
-
-Text snippets:
-{combined_text}
-
-Requirements:
-- Maximum 4 words
-- Capitalize each word
-- Be specific and descriptive
-- No articles (a, an, the)
-- Examples: "Machine Learning Research", "Climate Policy", "Space Exploration"
-
-Category title:"""
-
-    try:
-        response = client.chat.completions.create(model="gpt-5-nano", messages=[{"role": "system", "content": "You are a text categorization expert. Generate concise, accurate category titles."}, {"role": "user", "content": prompt}])
-        
-        title = response.choices[0].message.content.strip().strip('"\'')
-        title = ' '.join(word.capitalize() for word in title.split())
-        
-        if len(title.split()) > 4 or not title: return extract_fallback_title(texts)
-        
-        return title
-        
-    except Exception as e:
-        print(f"GPT API error: {e}")
-        return extract_fallback_title(texts)
-
-def extract_fallback_title(texts): #Fallback title generation if GPT fails
-    combined = " ".join(texts)
-    words = combined.lower().split()
-    stop_words = {'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with', 'by', 'from', 'is', 'are', 'was', 'were', 'been', 'be', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could', 'should', 'may', 'might', 'must', 'can', 'this', 'that', 'these', 'those', 'i', 'you', 'he', 'she', 'it', 'we', 'they', 'them', 'their', 'its'}
-    
-    word_freq = Counter()
-    for word in words:
-        clean = re.sub(r'[^\w]', '', word)
-        if clean not in stop_words and len(clean) > 3 and not clean.isdigit(): word_freq[clean] += 1
-    if not word_freq: return "General Topics"
-    
-    top_words = [word for word, _ in word_freq.most_common(2)]
-    return ' '.join(word.capitalize() for word in top_words)
-
-def process_topic_file(file_path): #Process a single topic file
+#PROCESSING FUNCTIONS
+def process_topic_file(file_path, usage=None): #Process a single topic file, adding its embedding/clustering time to usage
     try:
         with open(file_path) as f: data = json.load(f)
         if data.get('checked', False): return False
@@ -159,7 +48,12 @@ def process_topic_file(file_path): #Process a single topic file
         if not inputs: return False
         
         print(f"\nProcessing: {file_path}")
-        input_count, data['formatted'] = len(inputs), categorize_texts(inputs) #Update file with results
+        previous_clusters, next_cluster_id = data.get('clusters', []), next_unused_cluster_id(data.get('next_cluster_id'), data.get('clusters', []))
+        input_count, clusters = len(inputs), categorize_texts(inputs, previous_clusters=previous_clusters, usage=usage, next_cluster_id=next_cluster_id)
+        data['next_cluster_id'] = next_unused_cluster_id(next_cluster_id, clusters)
+        base_version = data.get('version') #Version the frontend should hold if it applied every earlier update
+        data['clusters'], data['formatted'] = clusters, format_clusters(clusters) #Update file with results
+        data['version'], delta = topic_version(data['formatted']), diff_clusters(previous_clusters, clusters)
         
         current_input_count = len(data.get('inputs', [])) #Check if inputs changed during processing
         if current_input_count == input_count:
@@ -174,19 +68,25 @@ def process_topic_file(file_path): #Process a single topic file
         
         if session_uid and topic_uid:
             updated_topics.append({"session_uid": session_uid, "topic_uid": topic_uid, "timestamp": datetime.now().isoformat()})
-            if 'formatted' in data: forward_to_frontend(session_uid, {topic_uid: data['formatted']}) #Forward to frontend
+            versions = {topic_uid: data['version']}
+            if not previous_clusters or not base_version: forward_to_frontend(session_uid, {topic_uid: data['formatted']}, versions) #Forward full topic on first categorization
+            elif delta: forward_to_frontend(session_uid, {topic_uid: data['formatted']}, versions, {topic_uid: {**delta, "base_version": base_version, "version": data['version']}}) #Forward only what changed
         return True
         
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
         return False
 
-def forward_to_frontend(session_uid, formatted_data): #Forward formatted data to frontend
+def forward_to_frontend(session_uid, formatted_data, versions=None, delta=None): #Forward formatted data (or a delta against its base version) to frontend
     try:
-        response = requests.post(f"{FRONTEND_URL}/update", json={"session_uid": session_uid, "formatted": formatted_data}, timeout=5)
+        payload = {"session_uid": session_uid, "delta": delta} if delta else {"session_uid": session_uid, "formatted": formatted_data, "versions": versions or {}}
+        response = requests.post(f"{FRONTEND_URL}/update", json=payload, timeout=5)
         if response.status_code == 200:
-            print(f"  ✓ Forwarded to frontend: {session_uid}")
+            print(f"  ✓ Forwarded to frontend: {session_uid}{' (delta)' if delta else ''}")
             return True
+        elif delta and response.status_code == 409: #Frontend is out of sync with the delta's base, resend everything
+            print("  ⚠ Frontend rejected delta, forwarding full topic")
+            return forward_to_frontend(session_uid, formatted_data, versions)
         else:
             print(f"  ✗ Frontend forward failed: {response.status_code}")
             return False
@@ -194,6 +94,119 @@ def forward_to_frontend(session_uid, formatted_data): #Forward formatted data to
         print(f"  ✗ Frontend connection error: {e}")
         return False
 
+#SUMMARY FUNCTIONS
+def summary_key(*parts): #Stable hash of everything a summary was built from
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+def cached_summary(key, build, stats, cacheable=True): #Return (summary, ok) for key, building it only on a miss; fallbacks are never cached
+    with summary_lock:
+        if key in summary_cache:
+            stats["cached"] += 1
+            return summary_cache[key], True
+        stats["computed"] += 1
+    summary, ok = build()
+    ok = ok and cacheable
+    if ok:
+        with summary_lock:
+            summary_cache[key] = summary
+            while len(summary_cache) > SUMMARY_CACHE_SIZE: summary_cache.pop(next(iter(summary_cache))) #Evict oldest entries
+    return summary, ok
+
+def generate_summary_with_gpt(instruction, content, fallback): #Generate a short summary using GPT, returns (summary, ok) where ok is False for the fallback
+    try:
+        summary = llm.complete(model="gpt-5-nano", messages=[{"role": "system", "content": f"You are an expert at summarizing conferences and discussions. {instruction} Only return the summary text - no explanations, JSON or code."}, {"role": "user", "content": content}], deadline=60)
+        summary = (summary or "").strip()
+        return (summary, True) if summary else (fallback, False)
+    except Exception as e:
+        print(f"GPT summary error: {e}")
+        return fallback, False
+
+def summarize_cluster(title, texts, stats): #Map step: summary of one cluster, recomputed only when its membership changes
+    def build():
+        content = f"Category: {title}\n" + "\n".join(f"- {text[:500]}" for text in texts)
+        return generate_summary_with_gpt("Summarize the contributions of this category in 2-3 sentences.", content, f"{title}: " + " ".join(text[:150] for text in texts[:2]))
+    return cached_summary(summary_key("cluster", sorted(texts)), build, stats)
+
+def summarize_clusters(topics, stats, pool): #Map step over every cluster of every topic in parallel, returns {topic_uid: [(title, summary, ok), ...]}
+    items = [(topic_uid, title, texts) for topic_uid, formatted in topics.items() for title, texts in formatted.items() if texts]
+    results = pool.map(lambda item: summarize_cluster(item[1], item[2], stats), items)
+    parts = {topic_uid: [] for topic_uid in topics}
+    for (topic_uid, title, _), (summary, ok) in zip(items, results): parts[topic_uid].append((title, summary, ok))
+    return parts
+
+def summarize_topic(topic_uid, parts, stats): #Reduce step: topic summary built from its cluster summaries, only cached if they all came from GPT
+    pairs = [(title, summary) for title, summary, _ in parts]
+    def build():
+        content = f"Topic: {topic_uid}\n" + "\n".join(f"{title}: {summary}" for title, summary in pairs)
+        return generate_summary_with_gpt("Combine these category summaries into a structured summary of the topic highlighting key points and decisions.", content, "\n".join(f"{title}: {summary}" for title, summary in pairs))
+    return cached_summary(summary_key("topic", topic_uid, pairs), build, stats, cacheable=all(ok for _, _, ok in parts))
+
+def summarize_session(session_uid, topics, stats, pool): #Reduce step: session summary built from its topic summaries, only cached if they all came from GPT
+    cluster_parts = summarize_clusters(topics, stats, pool)
+    topic_results = list(pool.map(lambda topic_uid: summarize_topic(topic_uid, cluster_parts[topic_uid], stats), topics))
+    pairs = [(topic_uid, summary) for topic_uid, (summary, _) in zip(topics, topic_results)]
+    def build():
+        content = f"Session: {session_uid}\n\n" + "\n\n".join(f"## {topic_uid}\n{summary}" for topic_uid, summary in pairs)
+        return generate_summary_with_gpt("Combine these topic summaries into a clear, structured summary of the whole session highlighting key points, decisions and important topics.", content, "\n\n".join(f"{topic_uid}\n{summary}" for topic_uid, summary in pairs))
+    summary, _ = cached_summary(summary_key("session", session_uid, pairs), build, stats, cacheable=all(ok for _, ok in topic_results))
+    return summary, dict(pairs)
+
+def iter_topic_files(session_path): #Yield (topic_uid, file_path, finished) for every topic file in a session folder
+    for file in sorted(os.listdir(session_path)):
+        if not file.endswith(".json"): continue
+        finished = file.endswith("_finished.json")
+        yield file[:-len("_finished.json")] if finished else file[:-len(".json")], os.path.join(session_path, file), finished
+
+def build_session_summary(session_uid, topic_uid=None): #Summarize the categorized topics of a session (or a single topic)
+    topics, stats = {}, Counter()
+    for uid, file_path, _ in iter_topic_files(os.path.join(SESSIONS_FOLDER, session_uid)):
+        if topic_uid and uid != topic_uid: continue
+        try:
+            with open(file_path) as f: formatted = json.load(f).get("formatted")
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Error reading {file_path}: {e}")
+            continue
+        if formatted: topics[uid] = formatted
+
+    if not topics: return None, {}, stats
+    with ThreadPoolExecutor(max_workers=llm.max_concurrency) as pool: #The gateway bounds the actual LLM concurrency
+        if topic_uid: return summarize_topic(topic_uid, summarize_clusters(topics, stats, pool)[topic_uid], stats)[0], {}, stats
+        summary, topic_summaries = summarize_session(session_uid, topics, stats, pool)
+    return summary, topic_summaries, stats
+
+#EXPORT FUNCTIONS
+EXPORT_EMBEDDING_BATCH = 256 #Texts embedded at once while exporting
+
+def export_session_lines(session_path, include_clusters=False, include_embeddings=False): #Yield one NDJSON line per topic and per input, one topic file in memory at a time
+    for topic_uid, file_path, finished in iter_topic_files(session_path):
+        try:
+            with open(file_path) as f: data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            yield json.dumps({"type": "error", "topic_uid": topic_uid, "error": str(e)}, ensure_ascii=False) + "\n"
+            continue
+        
+        inputs = data.get("inputs", [])
+        clusters = data.get("clusters") or [{"id": None, "title": title, "texts": texts} for title, texts in data.get("formatted", {}).items()] #Topics categorized before stable ids only have titles
+        topic = {"type": "topic", "session_uid": data.get("session_uid"), "topic_uid": topic_uid, "finished": finished, "checked": data.get("checked", False), "input_count": len(inputs)}
+        if include_clusters: topic["clusters"] = [{"id": c["id"], "title": c["title"], "size": len(c["texts"])} for c in clusters]
+        yield json.dumps(topic, ensure_ascii=False) + "\n"
+        
+        assignments = {} #{text: [cluster, ...]} | Duplicate texts keep one assignment per occurrence
+        if include_clusters:
+            for cluster in clusters:
+                for text in cluster["texts"]: assignments.setdefault(text, []).append(cluster)
+        
+        for start in range(0, len(inputs), EXPORT_EMBEDDING_BATCH):
+            batch = inputs[start:start + EXPORT_EMBEDDING_BATCH]
+            embeddings = embed_texts(batch, batch_size=EXPORT_EMBEDDING_BATCH) if include_embeddings else None
+            for offset, text in enumerate(batch):
+                line = {"type": "input", "topic_uid": topic_uid, "index": start + offset, "text": text}
+                if include_clusters:
+                    cluster = assignments[text].pop(0) if assignments.get(text) else {"id": None, "title": None}
+                    line["cluster_id"], line["cluster_title"] = cluster["id"], cluster["title"]
+                if include_embeddings: line["embedding"] = [round(float(x), 6) for x in embeddings[offset]]
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+
 async def background_processor(): #Background task to process unchecked files
     print("Background processor started")
     while processing_active:
@@ -205,9 +218,13 @@ async def background_processor(): #Background task to process unchecked files
                 
                 for file in os.listdir(folder_path):
                     if file.endswith(".json") and not file.endswith("_finished.json"): 
-                        file_path = os.path.join(folder_path, file)
-                        if process_topic_file(file_path): processed += 1
+                        if quotas.cpu_retry_after(folder): #Session used up its categorization compute budget, retry in a later round
+                            skipped += 1
+                            continue
+                        usage = {}
+                        if process_topic_file(os.path.join(folder_path, file), usage): processed += 1
                         else: skipped += 1
+                        if usage: quotas.record_cpu(folder, usage["compute_seconds"])
             
             if processed > 0 or skipped > 0: print(f"Summary: {processed} processed, {skipped} skipped")
             
@@ -218,6 +235,13 @@ async def background_processor(): #Background task to process unchecked files
 async def startup_event(): asyncio.create_task(background_processor()) #Start background processing on server startup
 
 #API ENDPOINTS
+def is_valid_uid(uid): return bool(uid) and os.path.basename(uid) == uid and uid not in (".", "..") and "\\" not in uid #A uid must name a single entry inside its parent folder
+
+def quota_response(error): #429/413 response for a request over a session limit, with a retry hint when waiting helps
+    content, headers = {"error": str(error)}, {}
+    if error.retry_after is not None: content["retry_after"], headers["Retry-After"] = error.retry_after, str(error.retry_after)
+    return JSONResponse(status_code=error.status_code, content=content, headers=headers)
+
 @app.post("/init")
 async def init(request: Request): #Create a new session folder
     data = await request.json()
@@ -238,6 +262,9 @@ async def create_topic(request: Request): #Create a new topic file within a sess
     session_path = os.path.join(SESSIONS_FOLDER, session_uid)
     if not os.path.exists(session_path): return JSONResponse(status_code=404, content={"error": f"Session {session_uid} not found"})
     
+    try: quotas.check_topic(session_uid, sum(1 for file in os.listdir(session_path) if file.endswith(".json")))
+    except QuotaExceeded as e: return quota_response(e)
+    
     topic_file, topic_data = os.path.join(session_path, f"{topic_uid}.json"), {"session_uid": session_uid, "topic_uid": topic_uid, "inputs": [], "checked": False}
     with open(topic_file, "w") as f: json.dump(topic_data, f, indent=2)
     
@@ -256,6 +283,9 @@ async def add_input(request: Request): #Add input text to a topic
     if not os.path.exists(topic_file): return JSONResponse(status_code=404, content={"error": f"Topic {topic_uid} not found"})
     
     with open(topic_file, "r") as f: content = json.load(f)
+    try: quotas.check_input(session_uid, text, len(content["inputs"]))
+    except QuotaExceeded as e: return quota_response(e)
+    
     content["inputs"].append(text)
     content["checked"] = False  #Mark for reprocessing
     
@@ -311,6 +341,25 @@ async def get_topic_data(session_uid: str, topic_uid: str): #Get data for a spec
     with open(topic_file, "r") as f: topic_data = json.load(f)
     return JSONResponse(status_code=200, content={"session_uid": session_uid, "topic_uid": topic_uid, "data": topic_data})
 
+@app.get("/export-session")
+async def export_session(session_uid: str, include_clusters: bool = False, include_embeddings: bool = False): #Stream all topics (active and finished) of a session as NDJSON
+    if not is_valid_uid(session_uid): return JSONResponse(status_code=400, content={"error": "Invalid session_uid"})
+    session_path = os.path.join(SESSIONS_FOLDER, session_uid)
+    if not os.path.isdir(session_path): return JSONResponse(status_code=404, content={"error": f"Session {session_uid} not found"})
+    
+    lines = export_session_lines(session_path, include_clusters, include_embeddings) #Sync generator, iterated in a worker thread by Starlette
+    ascii_name = re.sub(r'[^A-Za-z0-9._-]', '_', session_uid) #Plain fallback for clients without RFC 5987 support
+    return StreamingResponse(lines, media_type="application/x-ndjson", headers={"Content-Disposition": f"attachment; filename=\"{ascii_name}.ndjson\"; filename*=UTF-8''{quote(session_uid)}.ndjson"})
+
+@app.get("/summary")
+async def get_summary(session_uid: str, topic_uid: str = None): #Get a cached, incrementally built summary of a session or topic
+    if not is_valid_uid(session_uid): return JSONResponse(status_code=400, content={"error": "Invalid session_uid"})
+    if not os.path.isdir(os.path.join(SESSIONS_FOLDER, session_uid)): return JSONResponse(status_code=404, content={"error": f"Session {session_uid} not found"})
+
+    summary, topic_summaries, stats = await asyncio.to_thread(build_session_summary, session_uid, topic_uid)
+    if summary is None: return JSONResponse(status_code=404, content={"error": "No categorized topics to summarize yet"})
+    return JSONResponse(status_code=200, content={"session_uid": session_uid, "topic_uid": topic_uid, "summary": summary, "topics": topic_summaries, "computed": stats["computed"], "cached": stats["cached"]})
+
 @app.get("/status")
-async def status(): return JSONResponse(status_code=200, content={"status": "running", "processing_active": processing_active, "check_interval": CHECK_INTERVAL, "pending_updates": len(updated_topics)}) #Get server status
+async def status(): return JSONResponse(status_code=200, content={"status": "running", "processing_active": processing_active, "check_interval": CHECK_INTERVAL, "pending_updates": len(updated_topics), "llm": llm.status(), "session_limits": quotas.limits()}) #Get server status
 # Start mit: uvicorn combined_server:app --reload
\ No newline at end of file
@@ -2,12 +2,10 @@ require('dotenv').config();
 const express = require('express');
 const path = require('path');
 const fs = require('fs');
-const { OpenAI } = require('openai');
 const app = express();
 const PORT = 3000;
 const BACKEND_URL = 'http://localhost:8000';
-
-const openai = new OpenAI({ apiKey: process.env.OPENAI_API_KEY });
+const SUMMARY_TIMEOUT = 120000; // ms to wait for a backend summary
 
 app.use(express.json());
 app.use(express.static(path.join(__dirname, 'public')));
@@ -334,14 +332,18 @@ function sendInput() {
             text: input
         })
     })
-    .then(res => {
-        if (!res.ok) throw new Error('Failed to send input');
+    .then(async res => {
+        if (!res.ok) {
+            // Session limits (429/413) come back with a reason worth showing
+            const data = await res.json().catch(() => ({}));
+            throw new Error(data.error || 'Failed to send input');
+        }
         inputField.value = '';
         showMessage('Input sent successfully!', 'success');
     })
     .catch(err => {
         console.error(err);
-        showMessage('Failed to send input', 'error');
+        showMessage(err.message || 'Failed to send input', 'error');
     });
 }
 
@@ -532,7 +534,7 @@ async function generateAISummary() {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
-                message: JSON.stringify(topicsData, null, 2)
+                sessionName: '${name}'
             })
         });
         
@@ -1009,8 +1011,11 @@ function createTopic() {
             topicName: topicName 
         })
     })
-    .then(res => {
-        if (!res.ok) throw new Error('Failed to create topic');
+    .then(async res => {
+        if (!res.ok) {
+            const data = await res.json().catch(() => ({}));
+            throw new Error(data.error || 'Failed to create topic');
+        }
         return res.json();
     })
     .then(() => {
@@ -1020,7 +1025,7 @@ function createTopic() {
     })
     .catch(err => {
         console.error(err);
-        showMessage('Failed to create topic', 'error');
+        showMessage(err.message || 'Failed to create topic', 'error');
     });
 }
 
@@ -1042,14 +1047,18 @@ function sendInput() {
             text: input
         })
     })
-    .then(res => {
-        if (!res.ok) throw new Error('Failed to send input');
+    .then(async res => {
+        if (!res.ok) {
+            // Session limits (429/413) come back with a reason worth showing
+            const data = await res.json().catch(() => ({}));
+            throw new Error(data.error || 'Failed to send input');
+        }
         inputField.value = '';
         showMessage('Input sent successfully!', 'success');
     })
     .catch(err => {
         console.error(err);
-        showMessage('Failed to send input', 'error');
+        showMessage(err.message || 'Failed to send input', 'error');
     });
 }
 
@@ -1240,7 +1249,7 @@ async function generateAISummary() {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({
-                message: JSON.stringify(topicsData, null, 2)
+                sessionName: '${name}'
             })
         });
         
@@ -1486,7 +1495,13 @@ app.post('/createTopic', (req, res) => {
             topic_uid: topicName,
         })
     })
-    .then(response => {
+    .then(async response => {
+        if (response.status === 429) {
+            // Session quota reached, pass the reason and retry hint through
+            const data = await response.json();
+            if (data.retry_after) res.set('Retry-After', String(data.retry_after));
+            return res.status(429).json(data);
+        }
         if (!response.ok) {
             throw new Error(`Backend returned ${response.status}`);
         }
@@ -1498,11 +1513,48 @@ app.post('/createTopic', (req, res) => {
     });
 });
 
+// Apply a backend cluster delta to a single topic ({ title: texts }), returns null if it does not fit
+function applyTopicDelta(topic, delta) {
+    const result = { ...topic };
+    const removed = delta.removed || [];
+    const renamed = delta.renamed || {};
+
+    // Every title the delta refers to must exist, otherwise we are out of sync with the backend
+    for (const title of [...removed, ...Object.keys(renamed)]) {
+        if (!(title in result)) return null;
+    }
+
+    removed.forEach(title => delete result[title]);
+
+    // Renames are applied from a snapshot so swapped titles do not overwrite each other
+    const renamedTexts = Object.keys(renamed).map(oldTitle => [renamed[oldTitle], result[oldTitle]]);
+    Object.keys(renamed).forEach(oldTitle => delete result[oldTitle]);
+    renamedTexts.forEach(([newTitle, texts]) => { result[newTitle] = texts; });
+
+    for (const [title, texts] of Object.entries(delta.texts_removed || {})) {
+        if (!(title in result)) return null;
+        const remaining = [...result[title]];
+        for (const text of texts) {
+            const index = remaining.indexOf(text);
+            if (index === -1) return null;
+            remaining.splice(index, 1);
+        }
+        result[title] = remaining;
+    }
+
+    for (const [title, texts] of Object.entries(delta.texts_added || {})) {
+        if (!(title in result)) return null;
+        result[title] = [...result[title], ...texts];
+    }
+
+    Object.assign(result, delta.added || {});
+    return result;
+}
+
 // New endpoint to receive updates from Python server
 app.post('/update', (req, res) => {
-    const { session_uid, formatted } = req.body;
-    console.log(formatted)
-    if (!session_uid || !formatted) {
+    const { session_uid, formatted, versions, delta } = req.body;
+    if (!session_uid || (!formatted && !delta)) {
         return res.status(400).json({ error: 'Missing required fields' });
     }
 
@@ -1514,9 +1566,25 @@ app.post('/update', (req, res) => {
 
         // Read current topics file
         let sessionData = JSON.parse(fs.readFileSync(topicsFilePath, 'utf8'));
-
-        // Merge topics instead of replacing - accumulate all topics
-        sessionData.topics = { ...sessionData.topics, ...formatted };
+        sessionData.versions = sessionData.versions || {};
+
+        if (delta) {
+            // Deltas only carry what changed; reject them unless our copy is exactly the version they were computed against
+            for (const [topicName, topicDelta] of Object.entries(delta)) {
+                const inSync = topicDelta.base_version && sessionData.versions[topicName] === topicDelta.base_version;
+                const topic = inSync ? applyTopicDelta(sessionData.topics[topicName] || {}, topicDelta) : null;
+                if (!topic) return res.status(409).json({ error: `Topic ${topicName} out of sync` });
+                sessionData.topics[topicName] = topic;
+                sessionData.versions[topicName] = topicDelta.version;
+            }
+        } else {
+            // Merge topics instead of replacing - accumulate all topics
+            sessionData.topics = { ...sessionData.topics, ...formatted };
+            for (const topicName of Object.keys(formatted)) {
+                if (versions && versions[topicName]) sessionData.versions[topicName] = versions[topicName];
+                else delete sessionData.versions[topicName];
+            }
+        }
 
         // Write updated data back to file
         fs.writeFileSync(topicsFilePath, JSON.stringify(sessionData, null, 2));
@@ -1530,31 +1598,20 @@ app.post('/update', (req, res) => {
 
 
 app.post('/chat', async (req, res) => {
-    const { message } = req.body;
-    if (!message) return res.status(400).json({ error: 'Message is required.' });
+    const { sessionName } = req.body;
+    if (!sessionName) return res.status(400).json({ error: 'Session name is required.' });
 
+    // Session summaries are built by the backend from cached per-cluster summaries
     try {
-    const response = await openai.chat.completions.create({
-        model: "gpt-5-nano",
-        messages: [
-            {
-                role: "system",
-                content: `You are an expert at summarizing conferences and discussions. 
-                        You will receive a large JSON containing detailed information about topics, speakers, 
-                        contributions, and discussions. 
-                        Your task is to produce a clear and structured summary that highlights the key points, 
-                        decisions, and important topics. 
-                        Only return the summary text—do not include explanations, JSON, code, or any other content.`
-            },
-            { role: "user", content: message }
-        ]
-    });
-
-        const output = response.choices[0].message.content;
-        res.json({ response: output });
+        const response = await fetch(`${BACKEND_URL}/summary?session_uid=${encodeURIComponent(sessionName)}`, {
+            signal: AbortSignal.timeout(SUMMARY_TIMEOUT)
+        });
+        const data = await response.json();
+        if (!response.ok) return res.status(response.status).json({ error: data.error || 'Failed to get summary' });
+        res.json({ response: data.summary });
     } catch (err) {
-        console.error('GPT error:', err);
-        res.status(500).json({ error: 'Failed to get response from GPT' });
+        console.error('Summary error:', err);
+        res.status(err.name === 'TimeoutError' ? 504 : 500).json({ error: 'Failed to get summary from backend' });
     }
 });
 